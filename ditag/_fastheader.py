@@ -0,0 +1,138 @@
+"""A minimal DICOM header reader for the indexer.
+
+Reads a few top-level and file meta text elements straight from a memory-mapped file
+without building a pydicom Dataset. Only the common case is handled: a Part 10
+file with a preamble, little endian transfer syntax and plain ASCII values.
+For anything else ``read_tags`` returns ``None`` and the caller is expected to
+fall back to pydicom.
+"""
+import mmap
+import os
+import struct
+
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+# Transfer syntaxes whose dataset can't be walked in place
+_UNSUPPORTED_SYNTAXES = {
+    '1.2.840.10008.1.2.2',  # Explicit VR Big Endian
+    '1.2.840.10008.1.2.1.99',  # Deflated Explicit VR Little Endian
+}
+
+# Explicit VRs encoded with 2 reserved bytes and a 32-bit length
+_LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+_ITEM = 0xFFFEE000
+_ITEM_DELIMITER = 0xFFFEE00D
+_SEQUENCE_DELIMITER = 0xFFFEE0DD
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+_TAG = struct.Struct('<HH')
+_IMPLICIT_HEADER = struct.Struct('<HHI')
+_EXPLICIT_HEADER = struct.Struct('<HH2sH')
+_LONG_LENGTH = struct.Struct('<I')
+
+
+def read_tags(path, tags):
+    """Reads the values of the given top-level or file meta tags from a DICOM file.
+
+    Returns a dict mapping each tag found to its value as a string, or
+    ``None`` if the file can't be handled without pydicom.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 132:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[128:132] != b'DICM':
+                return None
+            try:
+                return _read_dataset(mm, tags)
+            except (struct.error, ValueError, RecursionError):
+                return None
+
+
+def _read_dataset(mm, tags):
+    """Walks the file meta and dataset in mm and returns the wanted values."""
+    end = len(mm)
+    offset = 132
+    transfer_syntax = None
+    wanted = set(tags)
+    values = {}
+
+    # The file meta group is always explicit VR little endian
+    while offset < end and _TAG.unpack_from(mm, offset)[0] == 0x0002:
+        tag, vr, length, value_offset = _element_header(mm, offset, False)
+        if tag == 0x00020010:
+            transfer_syntax = _text(mm, value_offset, length)
+        if tag in wanted:
+            values[tag] = _text(mm, value_offset, length)
+            wanted.discard(tag)
+        offset = value_offset + length
+
+    if not transfer_syntax or transfer_syntax in _UNSUPPORTED_SYNTAXES:
+        raise ValueError(f"Unsupported transfer syntax: {transfer_syntax}")
+    implicit = transfer_syntax == IMPLICIT_VR_LITTLE_ENDIAN
+
+    last = max(tags)
+    while offset < end and wanted:
+        tag, vr, length, value_offset = _element_header(mm, offset, implicit)
+        if tag > last:
+            break
+        if length == _UNDEFINED_LENGTH:
+            offset = _skip_sequence(mm, value_offset, implicit or vr == b'UN')
+            continue
+        if tag in wanted:
+            values[tag] = _text(mm, value_offset, length)
+            wanted.discard(tag)
+        offset = value_offset + length
+    return values
+
+
+def _element_header(mm, offset, implicit):
+    """Returns (tag, vr, length, value_offset) for the element at offset."""
+    group, element = _TAG.unpack_from(mm, offset)
+    tag = group << 16 | element
+    if implicit or group == 0xFFFE:
+        length = _IMPLICIT_HEADER.unpack_from(mm, offset)[2]
+        return tag, None, length, offset + 8
+
+    vr, length = _EXPLICIT_HEADER.unpack_from(mm, offset)[2:]
+    if not vr.isalpha():
+        raise ValueError(f"Invalid VR {vr!r} at offset {offset}")
+    if vr in _LONG_VRS:
+        return tag, vr, _LONG_LENGTH.unpack_from(mm, offset + 8)[0], offset + 12
+    return tag, vr, length, offset + 8
+
+
+def _skip_sequence(mm, offset, implicit):
+    """Returns the offset just past the undefined length sequence at offset."""
+    while True:
+        tag, vr, length, offset = _element_header(mm, offset, implicit)
+        if tag == _SEQUENCE_DELIMITER:
+            return offset
+        if tag != _ITEM:
+            raise ValueError(f"Unexpected tag {tag:08X} in sequence")
+        if length != _UNDEFINED_LENGTH:
+            offset += length
+            continue
+
+        # An undefined length item runs until its delimiter
+        while True:
+            tag, vr, length, value_offset = _element_header(mm, offset, implicit)
+            if tag == _ITEM_DELIMITER:
+                offset = value_offset
+                break
+            if length == _UNDEFINED_LENGTH:
+                offset = _skip_sequence(mm, value_offset, implicit or vr == b'UN')
+            else:
+                offset = value_offset + length
+
+
+def _text(mm, offset, length):
+    """Decodes a single-valued ASCII text value, stripping its padding."""
+    if offset + length > len(mm):
+        raise ValueError("Element value runs past the end of the file")
+    value = mm[offset:offset + length]
+    # Anything that needs a character set or splits into several values
+    # is left to pydicom
+    if not value.isascii() or b'\x1b' in value or b'\\' in value:
+        raise ValueError("Value needs pydicom to decode")
+    return value.decode('ascii').rstrip('\0 ')
@@ -7,10 +7,12 @@ from . import sender
 
 @click.group()
 @click.option('--config-file', type=click.Path(), default=config.DEFAULT_CONFIG_FILE, help='Path to config file.')
+@click.option('--verbose/--quiet', default=False, help='Show DICOM network debug logging.')
 @click.pass_context
-def cli(ctx, config_file):
+def cli(ctx, config_file, verbose):
     """A CLI tool for indexing, querying, and sending DICOM files."""
     ctx.ensure_object(dict)
+    sender.set_verbose(verbose)
     if os.path.exists(config_file):
         ctx.obj['config'] = config.get_config(config_file)
     else:
@@ -20,8 +22,8 @@ def cli(ctx, config_file):
 
 @cli.command()
 @click.option('--archive', required=True, type=click.Path(exists=True, file_okay=False), help='Path to DICOM archive directory.')
-@click.option('--append', is_flag=True, help='Append to existing database.')
-@click.option('--threads', default=4, type=int, help='Number of threads to use for indexing.')
+@click.option('--append', is_flag=True, help='Accepted for compatibility; indexing always adds to an existing database.')
+@click.option('--threads', type=int, help='Number of worker processes to use for indexing (default: number of CPUs).')
 @click.pass_context
 def index(ctx, archive, append, threads):
     """Index a DICOM archive."""
@@ -30,14 +32,14 @@ def index(ctx, archive, append, threads):
     
     # Ensure the directory for the database exists
     db_dir = os.path.dirname(db_path)
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
         
     cfg['DEFAULT']['archive_path'] = archive
     
-    indexer.index_archive(archive, db_path, append, threads)
-    config.save_config(cfg, ctx.obj['config_file'])
-    click.echo(f"Configuration saved to {ctx.obj['config_file']}")
+    indexer.index_archive(archive, db_path, threads)
+    if config.save_config(cfg, ctx.obj['config_file']):
+        click.echo(f"Configuration saved to {ctx.obj['config_file']}")
 
 
 @cli.command()
@@ -71,10 +73,11 @@ def send(ctx, destination, port, pacs_aetitle, myaet, input):
     cfg = ctx.obj['config']
     db_path = cfg['DEFAULT']['database']
     
-    dest = destination or cfg.get('PACS', 'destination', fallback=None)
-    port_str = str(port) if port else cfg.get('PACS', 'port', fallback=None)
-    pacs_aet = pacs_aetitle or cfg.get('PACS', 'aetitle', fallback=None)
-    my_aet = myaet or cfg.get('PACS', 'myaet', fallback='DITAG')
+    pacs = config.pacs_dict(cfg)
+    dest = destination or pacs['destination']
+    port_str = str(port) if port else pacs['port']
+    pacs_aet = pacs_aetitle or pacs['aetitle']
+    my_aet = myaet or pacs['myaet'] or 'DITAG'
 
     p = None
     if port_str:
@@ -97,8 +100,8 @@ def send(ctx, destination, port, pacs_aetitle, myaet, input):
     cfg['PACS']['myaet'] = my_aet
 
     sender.send_dicoms(db_path, my_aet, pacs_aet, dest, p, input)
-    config.save_config(cfg, ctx.obj['config_file'])
-    click.echo(f"Configuration updated and saved to {ctx.obj['config_file']}")
+    if config.save_config(cfg, ctx.obj['config_file']):
+        click.echo(f"Configuration updated and saved to {ctx.obj['config_file']}")
 
 if __name__ == '__main__':
     cli()
@@ -1,26 +1,104 @@
 import configparser
 import os
+import tempfile
 
 DEFAULT_CONFIG_DIR = os.path.expanduser('~/.ditag')
 DEFAULT_CONFIG_FILE = os.path.join(DEFAULT_CONFIG_DIR, 'config.ini')
 
+# Parsed config files keyed by path, stored as (mtime, config) pairs.
+_cache = {}
+
+class DitagConfigParser(configparser.ConfigParser):
+    """A ConfigParser that records whether it was modified after loading."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = False
+
+    def add_section(self, section):
+        super().add_section(section)
+        self.dirty = True
+
+    def set(self, section, option, value=None):
+        if self.get(section, option, raw=True, fallback=None) != value:
+            self.dirty = True
+        super().set(section, option, value)
+
+    def __setitem__(self, key, value):
+        # Replacing a section drops its old options, even if value is empty
+        super().__setitem__(key, value)
+        self.dirty = True
+
+    def remove_option(self, section, option):
+        removed = super().remove_option(section, option)
+        self.dirty = self.dirty or removed
+        return removed
+
+    def remove_section(self, section):
+        removed = super().remove_section(section)
+        self.dirty = self.dirty or removed
+        return removed
+
 def get_config(config_file=DEFAULT_CONFIG_FILE):
-    """Reads the configuration file and returns a config object."""
-    config = configparser.ConfigParser()
-    if os.path.exists(config_file):
-        config.read(config_file)
+    """Reads the configuration file and returns a config object.
+
+    Parsed files are cached by modification time, so the file is only re-read
+    when it has changed on disk or the cached config has unsaved changes.
+    """
+    try:
+        mtime = os.stat(config_file).st_mtime_ns
+    except FileNotFoundError:
+        return DitagConfigParser()
+    cached = _cache.get(config_file)
+    if cached and cached[0] == mtime and not cached[1].dirty:
+        return cached[1]
+    config = DitagConfigParser()
+    config.read(config_file)
+    _cache[config_file] = (mtime, config)
     return config
 
 def save_config(config, config_file=DEFAULT_CONFIG_FILE):
-    """Saves the configuration object to the config file."""
-    if not os.path.exists(DEFAULT_CONFIG_DIR):
-        os.makedirs(DEFAULT_CONFIG_DIR)
-    with open(config_file, 'w') as f:
-        config.write(f)
+    """Saves the configuration object to the config file.
+
+    Returns False without writing when the config has not changed since it was
+    loaded, True otherwise.
+    """
+    if not getattr(config, 'dirty', True) and os.path.exists(config_file):
+        return False
+    # Replace the file a symlinked config points to, not the link itself
+    target = os.path.realpath(config_file)
+    config_dir = os.path.dirname(target)
+    os.makedirs(config_dir, exist_ok=True)
+    # Write a uniquely named sibling file and rename it over the old one, so an
+    # interrupted or concurrent save never leaves a truncated config behind
+    with tempfile.NamedTemporaryFile('w', dir=config_dir, prefix='.config-', delete=False) as f:
+        try:
+            config.write(f)
+            f.flush()
+            os.fsync(f.fileno())
+            # NamedTemporaryFile is private to its owner; keep the config's mode
+            try:
+                mode = os.stat(target).st_mode & 0o777
+            except FileNotFoundError:
+                mode = 0o644
+            os.chmod(f.name, mode)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, target)
+    config.dirty = False
+    _cache[config_file] = (os.stat(config_file).st_mtime_ns, config)
+    return True
+
+PACS_KEYS = ('destination', 'port', 'aetitle', 'myaet')
+
+def pacs_dict(config):
+    """Returns the PACS section as a plain dict, with None for missing keys."""
+    return {key: config.get('PACS', key, fallback=None) for key in PACS_KEYS}
 
 def get_default_config():
     """Creates a default configuration object."""
-    config = configparser.ConfigParser()
+    config = DitagConfigParser()
     config['DEFAULT'] = {
         'database': os.path.join(DEFAULT_CONFIG_DIR, 'dicom.db'),
         'archive_path': ''
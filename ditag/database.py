@@ -1,12 +1,86 @@
 import sqlite3
+import operator
 import os
+import pathlib
+import queue
 import threading
+import time
 
-db_lock = threading.Lock()
+BATCH_SIZE = 1000
+# Maximum number of seconds a partial batch waits before it is written
+FLUSH_INTERVAL = 1.0
 
-def get_db_connection(db_path):
-    """Establishes a connection to the database."""
-    return sqlite3.connect(db_path, check_same_thread=False)
+_SQL_INSERT_SERIES = '''
+    INSERT INTO series (
+        StudyInstanceUID, SeriesInstanceUID, StudyDescription, 
+        SeriesDescription, PatientName, PatientID, StudyDate, archive_path
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (SeriesInstanceUID) DO NOTHING
+'''
+
+# The series_id is resolved in SQL so an instance insert never needs a
+# separate SELECT round-trip and stays a single executemany-able statement.
+# Re-indexing fills in the columns added by upgrade_tables for older rows.
+_SQL_INSERT_INSTANCE = '''
+    INSERT INTO instances (series_id, SOPInstanceUID, file_path, SOPClassUID, TransferSyntaxUID)
+    SELECT id, ?, ?, ?, ? FROM series WHERE SeriesInstanceUID = ?
+    ON CONFLICT (SOPInstanceUID) DO UPDATE SET
+        SOPClassUID = excluded.SOPClassUID,
+        TransferSyntaxUID = excluded.TransferSyntaxUID
+    WHERE instances.SOPClassUID IS NULL
+'''
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=30000",
+)
+
+# The journal settings need write access, so read-only connections skip them
+READONLY_PRAGMAS = PRAGMAS[2:]
+
+def get_db_connection(db_path, readonly=False):
+    """Establishes a connection to the database.
+
+    The connection is in autocommit mode; batched writes open their own
+    transaction (see ``flush_batch``). A ``readonly`` connection can't change
+    the database file, but TEMP tables still work.
+    """
+    if readonly:
+        uri = pathlib.Path(db_path).absolute().as_uri() + '?mode=ro'
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+        pragmas = READONLY_PRAGMAS
+    else:
+        conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        pragmas = PRAGMAS
+    for pragma in pragmas:
+        conn.execute(pragma)
+    return conn
+
+_tls = threading.local()
+
+def get_conn(db_path):
+    """Returns a connection to the database owned by the calling thread.
+
+    The connection is opened on first use and reused for later calls from the
+    same thread, leaving concurrency between threads to SQLite.
+    """
+    conns = getattr(_tls, 'conns', None)
+    if conns is None:
+        conns = _tls.conns = {}
+    conn = conns.get(db_path)
+    if conn is None:
+        conn = conns[db_path] = get_db_connection(db_path)
+    return conn
+
+def close_conn(db_path):
+    """Closes the calling thread's connection to the database, if any."""
+    conn = getattr(_tls, 'conns', {}).pop(db_path, None)
+    if conn is not None:
+        conn.close()
 
 def create_tables(conn):
     """Creates the necessary tables in the database."""
@@ -30,46 +104,136 @@ def create_tables(conn):
             series_id INTEGER,
             SOPInstanceUID TEXT UNIQUE,
             file_path TEXT,
+            SOPClassUID TEXT,
+            TransferSyntaxUID TEXT,
             FOREIGN KEY (series_id) REFERENCES series (id)
         )
     ''')
+    # Covers every column query_db selects, so date-filtered queries never touch the table
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_series_query ON series (
+            StudyDate, StudyDescription, SeriesDescription,
+            PatientName, PatientID, SeriesInstanceUID
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_instances_series ON instances (series_id)
+    ''')
     conn.commit()
+    upgrade_tables(conn)
+
+# Columns added since the first schema, with their definitions
+_ADDED_COLUMNS = (
+    ('instances', 'SOPClassUID', 'TEXT'),
+    ('instances', 'TransferSyntaxUID', 'TEXT'),
+)
+
+def has_column(conn, table, column):
+    """Returns whether the table in the database has the given column."""
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+def upgrade_tables(conn):
+    """Adds any columns missing from tables created by an older version.
+
+    Rows indexed before the upgrade keep NULL in the new columns until their
+    files are indexed again.
+    """
+    for table, column, definition in _ADDED_COLUMNS:
+        if not has_column(conn, table, column):
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# Order of the values in a metadata row tuple. The series columns come first
+# so both inserts can pick their values out of one tuple with itemgetter.
+METADATA_COLUMNS = (
+    'StudyInstanceUID', 'SeriesInstanceUID', 'StudyDescription', 'SeriesDescription',
+    'PatientName', 'PatientID', 'StudyDate', 'archive_path',
+    'SOPInstanceUID', 'file_path', 'SOPClassUID', 'TransferSyntaxUID',
+)
+
+_series_values = operator.itemgetter(0, 1, 2, 3, 4, 5, 6, 7)
+_instance_values = operator.itemgetter(8, 9, 10, 11, 1)
+
+def metadata_row(metadata):
+    """Returns a metadata dict as a tuple in METADATA_COLUMNS order, ready for executemany.
+
+    Missing values are stored as NULL, except PatientName which defaults to ''.
+    """
+    return (
+        metadata.get('StudyInstanceUID'),
+        metadata['SeriesInstanceUID'],
+        metadata.get('StudyDescription'),
+        metadata.get('SeriesDescription'),
+        metadata.get('PatientName') or '',
+        metadata.get('PatientID'),
+        metadata.get('StudyDate'),
+        metadata.get('archive_path'),
+        metadata['SOPInstanceUID'],
+        metadata['file_path'],
+        metadata.get('SOPClassUID'),
+        metadata.get('TransferSyntaxUID'),
+    )
+
+def flush_batch(conn, series_batch, instance_batch):
+    """Writes a batch of series and instance rows in a single transaction.
+
+    The transaction is committed once for the whole batch, or rolled back if
+    any insert fails.
+    """
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        cursor.executemany(_SQL_INSERT_SERIES, series_batch)
+        cursor.executemany(_SQL_INSERT_INSTANCE, instance_batch)
+
+def insert_dicom_metadata_many(conn, rows):
+    """Inserts a list of metadata row tuples (see METADATA_COLUMNS) into the database."""
+    flush_batch(conn, map(_series_values, rows), map(_instance_values, rows))
 
 def insert_dicom_metadata(conn, metadata):
     """Inserts DICOM metadata into the database."""
-    with db_lock:
-        cursor = conn.cursor()
-        
-        # Insert or get series
-        cursor.execute('''
-            SELECT id FROM series WHERE SeriesInstanceUID = ?
-        ''', (metadata['SeriesInstanceUID'],))
-        result = cursor.fetchone()
-        
-        if result:
-            series_id = result[0]
-        else:
-            cursor.execute('''
-                INSERT INTO series (
-                    StudyInstanceUID, SeriesInstanceUID, StudyDescription, 
-                    SeriesDescription, PatientName, PatientID, StudyDate, archive_path
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                metadata.get('StudyInstanceUID', ''),
-                metadata.get('SeriesInstanceUID', ''),
-                metadata.get('StudyDescription', ''),
-                metadata.get('SeriesDescription', ''),
-                metadata.get('PatientName', ''),
-                metadata.get('PatientID', ''),
-                metadata.get('StudyDate', ''),
-                metadata.get('archive_path', '')
-            ))
-            series_id = cursor.lastrowid
-
-        # Insert instance
-        cursor.execute('''
-            INSERT OR IGNORE INTO instances (series_id, SOPInstanceUID, file_path)
-            VALUES (?, ?, ?)
-        ''', (series_id, metadata['SOPInstanceUID'], metadata['file_path']))
-        
-        conn.commit()
+    insert_dicom_metadata_many(conn, [metadata_row(metadata)])
+
+def writer_loop(db_path, rows, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+    """Consumes metadata row tuples from a queue and writes them to the database in batches.
+
+    A batch is written once it holds ``batch_size`` rows or its oldest row is
+    ``flush_interval`` seconds old. A ``None`` item on the queue flushes any
+    pending rows and stops the writer. A failed write stops it at once, so
+    producers should queue rows with ``put_row`` rather than block on the queue.
+    """
+    conn = get_conn(db_path)
+    batch = []
+    started = 0
+    try:
+        while True:
+            try:
+                metadata = rows.get(timeout=flush_interval)
+            except queue.Empty:
+                pass
+            else:
+                if metadata is None:
+                    break
+                if not batch:
+                    started = time.monotonic()
+                batch.append(metadata)
+            if batch and (len(batch) >= batch_size or time.monotonic() - started >= flush_interval):
+                insert_dicom_metadata_many(conn, batch)
+                batch = []
+        if batch:
+            insert_dicom_metadata_many(conn, batch)
+    finally:
+        close_conn(db_path)
+
+def put_row(rows, writer, metadata):
+    """Queues an item for the writer_loop running in the ``writer`` future.
+
+    Returns False without queuing once the writer has stopped, e.g. after a
+    failed write, so the caller never blocks on a queue nobody reads.
+    """
+    while not writer.done():
+        try:
+            rows.put(metadata, timeout=FLUSH_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
@@ -1,75 +1,171 @@
+import collections
+import itertools
+import mmap
+import multiprocessing
 import os
+import queue
 import pydicom
 import click
 from . import database
+from . import _fastheader
 from pydicom.errors import InvalidDicomError
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pydicom.multival import MultiValue
 from rich.progress import Progress, BarColumn, TextColumn, TimeRemainingColumn, TaskID
 import time
 
+def iter_files(path):
+    """Yields the paths of all files under the given path.
+
+    Symlinked directories are not followed and unreadable directories are
+    skipped, as with os.walk.
+    """
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return
+    with it:
+        for entry in it:
+            # DirEntry answers from the directory listing, without a stat per entry
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file():
+                yield entry.path
+
 def get_subdirectories(path):
-    """Returns a list of all subdirectories in the given path."""
-    subdirectories = []
-    for dirpath, dirnames, filenames in os.walk(path):
-        if filenames:  # Only include directories that contain files
-            subdirectories.append(dirpath)
-    return subdirectories
-
-def process_file(file_path, archive_path, db_path):
-    """Processes a single DICOM file and inserts its metadata into the database."""
+    """Returns a Counter of the number of files in each subdirectory that contains files.
+
+    Only the counts are kept; the files themselves are walked again while
+    indexing, so memory doesn't grow with the size of the archive.
+    """
+    return collections.Counter(os.path.dirname(file_path) for file_path in iter_files(path))
+
+# Upper bound on metadata waiting for the database writer
+QUEUE_SIZE = 10000
+# Number of files handed to a worker process at a time
+CHUNK_SIZE = 64
+# Chunks kept in flight per worker process
+CHUNKS_PER_WORKER = 4
+
+# Tags read from each file, keyed by tag number
+INDEX_TAGS = {
+    0x00020010: 'TransferSyntaxUID',
+    0x00080016: 'SOPClassUID',
+    0x00080018: 'SOPInstanceUID',
+    0x00080020: 'StudyDate',
+    0x00081030: 'StudyDescription',
+    0x0008103E: 'SeriesDescription',
+    0x00100010: 'PatientName',
+    0x00100020: 'PatientID',
+    0x0020000D: 'StudyInstanceUID',
+    0x0020000E: 'SeriesInstanceUID',
+}
+
+# pydicom only builds elements for these; it adds Specific Character Set itself
+# and always reads the file meta
+_SPECIFIC_TAGS = [tag for tag in INDEX_TAGS if tag >> 16 != 0x0002]
+
+def read_metadata(file_path):
+    """Returns the INDEX_TAGS values present in a DICOM file, keyed by keyword.
+
+    Uses the fast header reader when it can handle the file and pydicom
+    otherwise.
+    """
+    tags = _fastheader.read_tags(file_path, INDEX_TAGS)
+    if tags is not None:
+        return {INDEX_TAGS[tag]: value for tag, value in tags.items()}
+    ds = _dcmread_mapped(file_path)
+    values = {keyword: _as_text(ds.get(keyword)) for keyword in INDEX_TAGS.values() if keyword in ds}
+    # pydicom keeps the file meta in a dataset of its own
+    transfer_syntax = ds.file_meta.get('TransferSyntaxUID')
+    if transfer_syntax:
+        values['TransferSyntaxUID'] = str(transfer_syntax)
+    return values
+
+def _dcmread_mapped(file_path):
+    """Reads a DICOM header with pydicom from a memory map of the file.
+
+    pydicom parses the header in many small reads; served from the map they
+    are plain memory copies rather than buffered file reads.
+    """
+    with open(file_path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty files can't be mapped
+            return pydicom.dcmread(f, stop_before_pixels=True, specific_tags=_SPECIFIC_TAGS)
+        with mm:
+            return pydicom.dcmread(mm, stop_before_pixels=True, specific_tags=_SPECIFIC_TAGS)
+
+def _as_text(value):
+    """Converts a pydicom element value to the plain string stored in the index."""
+    if value is None:
+        return None
+    if isinstance(value, MultiValue):
+        return '\\'.join(str(v) for v in value)
+    return str(value)
+
+def process_file(file_path, archive_path):
+    """Reads the metadata of a single DICOM file as a database row tuple.
+
+    Returns a ``(metadata, error)`` tuple where at most one item is set; both
+    are ``None`` for a file that isn't DICOM.
+    """
     try:
-        conn = database.get_db_connection(db_path)
-        ds = pydicom.dcmread(file_path, stop_before_pixels=True)
+        values = read_metadata(file_path)
         
-        if 'SeriesInstanceUID' not in ds or 'SOPInstanceUID' not in ds:
-            return f"Skipping {file_path} due to missing required UIDs."
-
-        metadata = {
-            'StudyInstanceUID': ds.get('StudyInstanceUID'),
-            'SeriesInstanceUID': ds.get('SeriesInstanceUID'),
-            'SOPInstanceUID': ds.get('SOPInstanceUID'),
-            'StudyDescription': ds.get('StudyDescription'),
-            'SeriesDescription': ds.get('SeriesDescription'),
-            'PatientName': str(ds.get('PatientName', '')),
-            'PatientID': ds.get('PatientID'),
-            'StudyDate': ds.get('StudyDate'),
-            'archive_path': archive_path,
-            'file_path': file_path
-        }
-        database.insert_dicom_metadata(conn, metadata)
-        conn.close()
-        return None
+        if 'SeriesInstanceUID' not in values or 'SOPInstanceUID' not in values:
+            return None, f"Skipping {file_path} due to missing required UIDs."
+
+        values['archive_path'] = archive_path
+        values['file_path'] = file_path
+        return database.metadata_row(values), None
 
     except InvalidDicomError:
-        return f"Skipping non-DICOM file: {file_path}"
+        return None, None
     except Exception as e:
-        return f"Could not read {file_path}: {e}"
+        return None, f"Could not read {file_path}: {e}"
 
-def process_subdirectory(subdirectory_path, archive_path, db_path, progress, task_id):
-    """Processes all DICOM files in a single subdirectory."""
-    files = [os.path.join(subdirectory_path, f) for f in os.listdir(subdirectory_path) if os.path.isfile(os.path.join(subdirectory_path, f))]
-    progress.update(task_id, total=len(files), description=f"[cyan]Processing: {os.path.basename(subdirectory_path)}[/cyan]")
-    
-    for file_path in files:
-        error = process_file(file_path, archive_path, db_path)
-        if error:
-            progress.console.print(error)
-        progress.update(task_id, advance=1)
-    
-    progress.update(task_id, description=f"[green]Finished: {os.path.basename(subdirectory_path)}[/green]")
+def process_files(file_paths, archive_path):
+    """Processes a chunk of files, returning a list of process_file results."""
+    return [process_file(file_path, archive_path) for file_path in file_paths]
 
+def map_files(executor, file_paths, archive_path, in_flight):
+    """Yields ``(file_path, result)`` pairs for each file, in order.
 
-def index_archive(archive_path, db_path, append=False, threads=4):
+    Unlike ``executor.map``, chunks are submitted lazily and at most
+    ``in_flight`` of them are pending at once. Given a lazy iterator of paths,
+    memory stays bounded by the worker count instead of growing with the
+    archive.
+    """
+    pending = collections.deque()
+    file_paths = iter(file_paths)
+    while True:
+        chunk = list(itertools.islice(file_paths, CHUNK_SIZE))
+        if chunk:
+            pending.append((chunk, executor.submit(process_files, chunk, archive_path)))
+        if not pending:
+            return
+        if not chunk or len(pending) >= in_flight:
+            done, future = pending.popleft()
+            yield from zip(done, future.result())
+
+def make_progress():
+    """Returns the progress display shared by the index and send commands."""
+    return Progress(
+        TextColumn("[bold blue]{task.description}", justify="right"),
+        BarColumn(bar_width=None),
+        "[progress.percentage]{task.percentage:>3.0f}%",
+        "•",
+        TimeRemainingColumn(),
+        transient=True,
+    )
+
+def index_archive(archive_path, db_path, threads=None):
     """Indexes the DICOM files in the archive path and stores the metadata in the database."""
     if not os.path.exists(archive_path):
         click.echo(f"Error: Archive path not found at {archive_path}")
         return
 
-    conn = database.get_db_connection(db_path)
-    if not append:
-        database.create_tables(conn)
-    conn.close()
-
     click.echo("Finding subdirectories to index...")
     subdirectories = get_subdirectories(archive_path)
     
@@ -82,18 +178,61 @@ def index_archive(archive_path, db_path, append=False, threads=4):
         click.echo("Indexing cancelled.")
         return
 
-    with Progress(
-        TextColumn("[bold blue]{task.description}", justify="right"),
-        BarColumn(bar_width=None),
-        "[progress.percentage]{task.percentage:>3.0f}%",
-        "•",
-        TimeRemainingColumn(),
-        transient=True,
-    ) as progress:
-        with ThreadPoolExecutor(max_workers=threads) as executor:
-            tasks = {executor.submit(process_subdirectory, subdir, archive_path, db_path, progress, progress.add_task(f"Queued: {os.path.basename(subdir)}", total=1)): subdir for subdir in subdirectories}
-            
-            for future in tasks:
-                future.result() # wait for all tasks to complete
+    # Workers never touch SQLite: this thread's connection sets up the schema and
+    # runs ANALYZE at the end, and the writer thread owns the only other one.
+    conn = database.get_conn(db_path)
+    # Also brings databases from older versions up to the current schema
+    database.create_tables(conn)
+
+    # A single writer thread owns the database connection and batches the inserts.
+    rows = queue.Queue(maxsize=QUEUE_SIZE)
+    writer_pool = ThreadPoolExecutor(max_workers=1)
+    writer = writer_pool.submit(database.writer_loop, db_path, rows)
+
+    try:
+        with make_progress() as progress:
+            skipped = 0
+            tasks = {}
+            done = collections.Counter()
+            for subdir, count in subdirectories.items():
+                tasks[subdir] = progress.add_task(f"Queued: {os.path.basename(subdir)}", total=count)
+
+            # Parsing is CPU-bound, so it runs in worker processes; spawn keeps
+            # them clear of the writer and progress threads in this process.
+            workers = threads or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                # Results arrive in walk order, which can interleave a directory's
+                # files with those of its subdirectories
+                for file_path, (metadata, error) in map_files(executor, iter_files(archive_path), archive_path, workers * CHUNKS_PER_WORKER):
+                    subdir = os.path.dirname(file_path)
+                    if metadata:
+                        if not database.put_row(rows, writer, metadata):
+                            # The writer failed: stop parsing and raise its error below
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            break
+                    elif error:
+                        progress.console.print(error)
+                    else:
+                        skipped += 1
+                    if subdir not in tasks: # created after the count
+                        continue
+                    done[subdir] += 1
+                    # Only relabel a subdirectory's task when it starts and finishes
+                    if done[subdir] == subdirectories[subdir]:
+                        progress.update(tasks[subdir], advance=1, description=f"[green]Finished: {os.path.basename(subdir)}[/green]")
+                    elif done[subdir] == 1:
+                        progress.update(tasks[subdir], advance=1, description=f"[cyan]Processing: {os.path.basename(subdir)}[/cyan]")
+                    else:
+                        progress.update(tasks[subdir], advance=1)
+    finally:
+        database.put_row(rows, writer, None)
+        writer_pool.shutdown()
+    writer.result() # re-raise any database error
+
+    # Refresh planner statistics so queries pick the indexes
+    conn.execute("ANALYZE")
+    database.close_conn(db_path)
 
+    if skipped:
+        click.echo(f"Skipped {skipped} non-DICOM files.")
     click.echo(f"Indexing complete. Database updated at {db_path}")
\ No newline at end of file
@@ -1,17 +1,28 @@
+import contextlib
 import csv
+import functools
 import re
 import sqlite3
 import sys
 import click
 from . import database
 
+FETCH_SIZE = 10000
+
+COLUMNS = ('StudyDescription', 'SeriesDescription', 'PatientName', 'PatientID', 'StudyDate', 'SeriesInstanceUID')
+
+_SQL_SELECT_SERIES = "SELECT DISTINCT " + ", ".join(f"s.{c}" for c in COLUMNS) + " FROM series s"
+
+# Characters that give a pattern regex meaning; without them it is a plain substring
+_REGEX_METACHARACTERS = frozenset('.^$*+?{}[]\\|()')
+
 def query_db(db_path, sdate=None, edate=None, date=None, targets=None, pattern=None, output=None):
     """Queries the database and prints the results."""
-    conn = database.get_db_connection(db_path)
+    conn = database.get_db_connection(db_path, readonly=True)
     conn.create_function("REGEXP", 2, regexp)
     cursor = conn.cursor()
 
-    query = "SELECT DISTINCT s.StudyDescription, s.SeriesDescription, s.PatientName, s.PatientID, s.StudyDate, s.SeriesInstanceUID FROM series s"
+    query = _SQL_SELECT_SERIES
     conditions = []
     params = []
 
@@ -26,9 +37,14 @@ def query_db(db_path, sdate=None, edate=None, date=None, targets=None, pattern=N
         params.append(edate)
 
     if pattern and targets:
+        # A plain substring is matched by SQLite itself, skipping the Python callback per row
+        if _REGEX_METACHARACTERS.isdisjoint(pattern):
+            condition = "instr(s.{}, ?) > 0"
+        else:
+            condition = "s.{} REGEXP ?"
         target_conditions = []
         for target in targets:
-            target_conditions.append(f"s.{target} REGEXP ?")
+            target_conditions.append(condition.format(target))
             params.append(pattern)
         conditions.append("(" + " OR ".join(target_conditions) + ")")
 
@@ -36,21 +52,34 @@ def query_db(db_path, sdate=None, edate=None, date=None, targets=None, pattern=N
         query += " WHERE " + " AND ".join(conditions)
 
     cursor.execute(query, params)
-    results = cursor.fetchall()
     
     if output:
-        writer = csv.writer(open(output, 'w', newline=''))
+        out = open(output, 'w', newline='', buffering=1 << 20)
     else:
-        writer = csv.writer(sys.stdout)
-        
-    writer.writerow(['StudyDescription', 'SeriesDescription', 'PatientName', 'PatientID', 'StudyDate', 'SeriesInstanceUID'])
-    writer.writerows(results)
+        out = contextlib.nullcontext(sys.stdout)
 
-    click.echo(f"Found {len(results)} matching series.", err=True)
+    with out as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+
+        # Stream the results in chunks rather than materializing them all
+        count = 0
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            writer.writerows(rows)
+            count += len(rows)
+
+    click.echo(f"Found {count} matching series.", err=True)
 
     conn.close()
 
+@functools.lru_cache(maxsize=64)
+def _compile(expr):
+    """Compiles a regex once per distinct pattern."""
+    return re.compile(expr)
+
 def regexp(expr, item):
-    """Regex function for SQLite."""
-    reg = re.compile(expr)
-    return reg.search(item) is not None
+    """Regex function for SQLite. NULL values never match."""
+    return item is not None and _compile(expr).search(item) is not None
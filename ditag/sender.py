@@ -1,96 +1,235 @@
+import collections
+import contextlib
 import csv
+import logging
+import mmap
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import click
 import pydicom
-from pynetdicom import AE, debug_logger
+from pynetdicom import AE, _config, debug_logger
 from pynetdicom.presentation import build_context
+from pynetdicom.status import STATUS_SUCCESS, STATUS_WARNING, code_to_category
 from . import database
+from .indexer import make_progress
 
-debug_logger()
+# SOP class discovery reads files on a few threads when the index lacks them
+READ_WORKERS = 8
+PREFETCH = 16
+
+# Most presentation contexts an association can carry
+MAX_CONTEXTS = 128
+
+# Cells that mark the first row of an input CSV as its header
+HEADER = {'SeriesInstanceUID'}
+
+_SQL_CREATE_WANTED = "CREATE TEMP TABLE wanted (uid TEXT PRIMARY KEY)"
+_SQL_INSERT_WANTED = "INSERT OR IGNORE INTO wanted (uid) VALUES (?)"
+
+# SOP classes and transfer syntaxes stored by the indexer for the requested series
+_SQL_SELECT_WANTED_CONTEXTS = '''
+    SELECT DISTINCT i.SOPClassUID, i.TransferSyntaxUID FROM instances i
+    JOIN series s ON i.series_id = s.id
+    JOIN wanted w ON s.SeriesInstanceUID = w.uid
+    WHERE i.SOPClassUID IS NOT NULL
+'''
+
+# One representative file per requested series, for databases without SOP classes
+_SQL_SELECT_SERIES_FILES = '''
+    SELECT MIN(i.file_path) FROM instances i
+    JOIN series s ON i.series_id = s.id
+    JOIN wanted w ON s.SeriesInstanceUID = w.uid
+    GROUP BY s.id
+'''
+
+# Likewise, but only among instances indexed before SOP classes were stored
+_SQL_SELECT_UNKNOWN_CLASS_FILES = '''
+    SELECT MIN(i.file_path) FROM instances i
+    JOIN series s ON i.series_id = s.id
+    JOIN wanted w ON s.SeriesInstanceUID = w.uid
+    WHERE i.SOPClassUID IS NULL
+    GROUP BY s.id
+'''
+
+_SQL_COUNT_WANTED_FILES = '''
+    SELECT COUNT(*) FROM instances i
+    JOIN series s ON i.series_id = s.id
+    JOIN wanted w ON s.SeriesInstanceUID = w.uid
+'''
+
+# Series are sent in input order
+_SQL_SELECT_WANTED_FILES = '''
+    SELECT i.file_path, i.SOPClassUID, i.TransferSyntaxUID FROM instances i
+    JOIN series s ON i.series_id = s.id
+    JOIN wanted w ON s.SeriesInstanceUID = w.uid
+    ORDER BY w.rowid, i.id
+'''
+
+# Likewise, for databases indexed before these columns were added
+_SQL_SELECT_WANTED_FILES_ONLY = '''
+    SELECT i.file_path, NULL, NULL FROM instances i
+    JOIN series s ON i.series_id = s.id
+    JOIN wanted w ON s.SeriesInstanceUID = w.uid
+    ORDER BY w.rowid, i.id
+'''
+
+def set_verbose(verbose):
+    """Turns pynetdicom's association and PDU debug logging on or off."""
+    if verbose:
+        debug_logger()
+    else:
+        logging.getLogger('pynetdicom').setLevel(logging.WARNING)
+
+@contextlib.contextmanager
+def chunked_sends():
+    """Makes send_c_store stream files given by path straight from disk.
+
+    Files are then sent without being decoded and re-encoded. pynetdicom's
+    setting is global, so it is restored on exit.
+    """
+    previous = _config.STORE_SEND_CHUNKED_DATASET
+    _config.STORE_SEND_CHUNKED_DATASET = True
+    try:
+        yield
+    finally:
+        _config.STORE_SEND_CHUNKED_DATASET = previous
+
+def prefetch(executor, func, items, in_flight):
+    """Yields ``(item, future)`` pairs in order, with at most ``in_flight`` calls pending."""
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, executor.submit(func, item)))
+        if len(pending) >= in_flight:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+def read_context(file_path):
+    """Returns the SOP Class UID and transfer syntax of a DICOM file."""
+    ds = pydicom.dcmread(file_path, stop_before_pixels=True, specific_tags=["SOPClassUID"])
+    return ds.SOPClassUID, ds.file_meta.get('TransferSyntaxUID')
+
+def build_contexts(pairs):
+    """Returns the presentation contexts to request for (SOP class, transfer syntax) pairs.
+
+    Each SOP class gets a context offering the uncompressed transfer syntaxes,
+    which pynetdicom can convert between. As far as the context limit allows,
+    each pair also gets a context of its own, so files already in an accepted
+    transfer syntax can be sent as they are.
+    """
+    contexts = [build_context(sop_class) for sop_class in sorted({sop_class for sop_class, _ in pairs})]
+    for sop_class, transfer_syntax in sorted(pair for pair in pairs if pair[1]):
+        if len(contexts) >= MAX_CONTEXTS:
+            break
+        contexts.append(build_context(sop_class, transfer_syntax))
+    return contexts
+
+def store(assoc, file_path, stream=True):
+    """Sends a DICOM file with C-STORE.
+
+    With ``stream`` the file is first sent from disk as it is. That needs an
+    accepted context with its exact transfer syntax, so otherwise, or if it
+    fails, the file is decoded for pynetdicom to convert. Returns the response
+    status and whether the file was streamed.
+    """
+    if stream:
+        try:
+            return assoc.send_c_store(file_path), True
+        except (AttributeError, ValueError):
+            pass # no exact context, or incomplete file meta
+    # Parsing from a map of the file saves a buffered read per element
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return assoc.send_c_store(pydicom.dcmread(mm)), False
 
 def send_dicoms(db_path, myaet, pacs_aet, destination, port, input_file=None):
     """Sends DICOM files to a PACS destination."""
     
     series_uids = []
     if input_file:
-        with open(input_file, 'r') as f:
+        with open(input_file, 'r', newline='', buffering=1 << 20) as f:
             reader = csv.reader(f)
             # Skip header if it exists
-            try:
-                first_row = next(reader)
-                if 'SeriesInstanceUID' not in first_row:
-                    series_uids.append(first_row[5])
-            except StopIteration:
-                pass # Empty file
-            for row in reader:
-                if row:
-                    series_uids.append(row[5]) # Assumes SeriesInstanceUID is the 6th column
+            first_row = next(reader, None) # None for an empty file
+            if first_row and HEADER.isdisjoint(first_row):
+                series_uids.append(first_row[5])
+            series_uids.extend(row[5] for row in reader if row) # Assumes SeriesInstanceUID is the 6th column
     else:
         reader = csv.reader(sys.stdin)
-        try:
-            next(reader) # skip header
-        except StopIteration:
-            pass
-        for row in reader:
-            if row:
-                series_uids.append(row[5])
+        next(reader, None) # skip header
+        series_uids.extend(row[5] for row in reader if row)
 
     if not series_uids:
         click.echo("No series to send.")
         return
 
-    conn = database.get_db_connection(db_path)
+    conn = database.get_db_connection(db_path, readonly=True)
     cursor = conn.cursor()
 
+    # Load the requested series into a temp table so the file lookup is one join
+    cursor.execute(_SQL_CREATE_WANTED)
+    cursor.executemany(_SQL_INSERT_WANTED, ((uid,) for uid in series_uids))
+
     ae = AE(ae_title=myaet)
     
     # Dynamically build presentation contexts
-    sop_classes = set()
-    for series_uid in series_uids:
-        cursor.execute('''
-            SELECT i.file_path FROM instances i
-            JOIN series s ON i.series_id = s.id
-            WHERE s.SeriesInstanceUID = ?
-            LIMIT 1
-        ''', (series_uid,))
-        file_path = cursor.fetchone()
-        if file_path:
+    indexed = database.has_column(conn, 'instances', 'TransferSyntaxUID')
+    pairs = set()
+    if indexed:
+        cursor.execute(_SQL_SELECT_WANTED_CONTEXTS)
+        pairs.update(cursor)
+        cursor.execute(_SQL_SELECT_UNKNOWN_CLASS_FILES)
+    else:
+        cursor.execute(_SQL_SELECT_SERIES_FILES)
+    # Only series without a stored SOP class need a file read
+    file_paths = [file_path for (file_path,) in cursor]
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        for file_path, future in prefetch(executor, read_context, file_paths, PREFETCH):
             try:
-                ds = pydicom.dcmread(file_path[0], stop_before_pixels=True)
-                sop_classes.add(ds.SOPClassUID)
+                pairs.add(future.result())
             except Exception as e:
-                click.echo(f"Could not read SOP Class from {file_path[0]}: {e}")
+                click.echo(f"Could not read SOP Class from {file_path}: {e}")
 
-    ae.requested_contexts = [build_context(sop) for sop in sop_classes]
+    ae.requested_contexts = build_contexts(pairs)
     if not ae.requested_contexts:
         click.echo("No valid SOP classes found for the series to be sent. Aborting.")
         conn.close()
         return
 
-    assoc = ae.associate(destination, port, ae_title=pacs_aet)
-
-    if assoc.is_established:
-        for series_uid in series_uids:
-            cursor.execute('''
-                SELECT i.file_path FROM instances i
-                JOIN series s ON i.series_id = s.id
-                WHERE s.SeriesInstanceUID = ?
-            ''', (series_uid,))
-            file_paths = [row[0] for row in cursor.fetchall()]
-
-            for file_path in file_paths:
-                try:
-                    ds = pydicom.dcmread(file_path)
-                    status = assoc.send_c_store(ds)
-                    if status:
-                        click.echo(f"C-STORE request status: 0x{status.Status:04x} for {file_path}")
-                    else:
-                        click.echo(f"Connection timed out, was aborted or received invalid response for {file_path}")
-                except Exception as e:
-                    click.echo(f"Error sending {file_path}: {e}")
+    with chunked_sends():
+        assoc = ae.associate(destination, port, ae_title=pacs_aet)
+
+        if assoc.is_established:
+            cursor.execute(_SQL_COUNT_WANTED_FILES)
+            (total,) = cursor.fetchone()
+            accepted = {(cx.abstract_syntax, cx.transfer_syntax[0]) for cx in assoc.accepted_contexts}
+            sent = streamed = 0
+            with make_progress() as progress:
+                task = progress.add_task("Sending", total=total)
+                cursor.execute(_SQL_SELECT_WANTED_FILES if indexed else _SQL_SELECT_WANTED_FILES_ONLY)
+                for file_path, sop_class, transfer_syntax in cursor:
+                    # Successful stores only advance the bar; warnings and failures are reported
+                    try:
+                        # Files indexed without their SOP class are tried as they are
+                        stream = sop_class is None or (sop_class, transfer_syntax) in accepted
+                        status, was_streamed = store(assoc, file_path, stream)
+                        category = code_to_category(status.Status) if status else None
+                        if not status:
+                            progress.console.print(f"Connection timed out, was aborted or received invalid response for {file_path}")
+                        elif category not in (STATUS_SUCCESS, STATUS_WARNING):
+                            progress.console.print(f"C-STORE request status: 0x{status.Status:04x} for {file_path}")
+                        else:
+                            # Warning statuses (e.g. coerced elements) still mean the instance was stored
+                            if category == STATUS_WARNING:
+                                progress.console.print(f"C-STORE warning status: 0x{status.Status:04x} for {file_path}")
+                            sent += 1
+                            streamed += was_streamed
+                    except Exception as e:
+                        progress.console.print(f"Error sending {file_path}: {e}")
+                    progress.update(task, advance=1)
+            click.echo(f"Sent {sent} of {total} files ({streamed} streamed from disk, {sent - streamed} re-encoded).")
         
-        assoc.release()
-    else:
-        click.echo("Association rejected, aborted or never connected")
+            assoc.release()
+        else:
+            click.echo("Association rejected, aborted or never connected")
 
     conn.close()
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import (
+    CTImageStorage, ExplicitVRBigEndian, ExplicitVRLittleEndian,
+    ImplicitVRLittleEndian, generate_uid,
+)
+
+from ditag import _fastheader
+from ditag.indexer import INDEX_TAGS
+
+
+def make_dataset(transfer_syntax, undefined_length=False):
+    """Returns a small CT dataset with nested sequences before the indexed tags."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = transfer_syntax
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyDate = '20200101'
+    ds.StudyDescription = 'Head'
+
+    # (0008,1032) sits between StudyDescription and SeriesDescription
+    reference = Dataset()
+    reference.ReferencedSOPInstanceUID = generate_uid()
+    code = Dataset()
+    code.CodeValue = 'X'
+    code.CodeMeaning = 'y'
+    code.ReferencedImageSequence = Sequence([reference, reference])
+    code.ReferencedImageSequence.is_undefined_length = undefined_length
+    ds.ProcedureCodeSequence = Sequence([code, code])
+    ds.ProcedureCodeSequence.is_undefined_length = undefined_length
+
+    ds.SeriesDescription = 'Ax T1'
+    ds.PatientName = 'Doe^J'
+    ds.PatientID = 'P1'
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Rows = 4
+    ds.Columns = 4
+    ds.BitsAllocated = 8
+    ds.PixelData = bytes(16)
+    return ds
+
+
+class ReadTagsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def save(self, ds, name='test.dcm'):
+        path = os.path.join(self.tmp.name, name)
+        ds.save_as(path, enforce_file_format=True)
+        return path
+
+    def write(self, data, name='test.dcm'):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def assertMatchesPydicom(self, path):
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+        expected = {tag: str(ds[tag].value) for tag in INDEX_TAGS if tag in ds}
+        expected.update({tag: str(ds.file_meta[tag].value) for tag in INDEX_TAGS if tag in ds.file_meta})
+        self.assertEqual(_fastheader.read_tags(path, INDEX_TAGS), expected)
+
+    def test_little_endian_syntaxes(self):
+        for transfer_syntax in (ImplicitVRLittleEndian, ExplicitVRLittleEndian):
+            for undefined_length in (False, True):
+                with self.subTest(transfer_syntax=transfer_syntax.name, undefined_length=undefined_length):
+                    self.assertMatchesPydicom(self.save(make_dataset(transfer_syntax, undefined_length)))
+
+    def test_padding_and_leading_spaces(self):
+        ds = make_dataset(ExplicitVRLittleEndian)
+        ds.StudyDescription = ' Head '
+        ds.SeriesDescription = ''
+        self.assertMatchesPydicom(self.save(ds))
+
+    def test_missing_tag(self):
+        ds = make_dataset(ImplicitVRLittleEndian)
+        del ds.SeriesInstanceUID
+        path = self.save(ds)
+        self.assertMatchesPydicom(path)
+        self.assertNotIn(0x0020000E, _fastheader.read_tags(path, INDEX_TAGS))
+
+    def test_non_ascii_value(self):
+        ds = make_dataset(ExplicitVRLittleEndian)
+        ds.SpecificCharacterSet = 'ISO_IR 100'
+        ds.PatientName = 'Müller^Hans'
+        self.assertIsNone(_fastheader.read_tags(self.save(ds), INDEX_TAGS))
+
+    def test_multi_valued_text(self):
+        ds = make_dataset(ExplicitVRLittleEndian)
+        ds.StudyDescription = ['a', 'b']
+        self.assertIsNone(_fastheader.read_tags(self.save(ds), INDEX_TAGS))
+
+    def test_big_endian(self):
+        path = self.save(make_dataset(ExplicitVRBigEndian))
+        self.assertIsNone(_fastheader.read_tags(path, INDEX_TAGS))
+
+    def test_truncated_value(self):
+        ds = make_dataset(ExplicitVRLittleEndian)
+        with open(self.save(ds), 'rb') as f:
+            data = f.read()
+        # Cut the file inside the SeriesInstanceUID value
+        uid = ds.SeriesInstanceUID.encode()
+        end = data.index(uid) + len(uid) // 2
+        self.assertIsNone(_fastheader.read_tags(self.write(data[:end], 'truncated.dcm'), INDEX_TAGS))
+
+    def test_not_dicom(self):
+        self.assertIsNone(_fastheader.read_tags(self.write(b''), INDEX_TAGS))
+        self.assertIsNone(_fastheader.read_tags(self.write(b'x' * 200), INDEX_TAGS))
+
+
+if __name__ == '__main__':
+    unittest.main()